@@ -0,0 +1,403 @@
+# core.py
+# ------------------------------------------------------------
+# Data + chart helpers for streamlit_app.py (ETS dashboard).
+# Kept out of the page script: Streamlit re-executes the script on
+# every rerun, while this module is imported once per process.
+# Raw sheet reading lives in workbook.py (shared with scripts/build_parquet.py).
+# ------------------------------------------------------------
+
+from __future__ import annotations
+
+import os
+import re
+import tempfile
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import plotly.express as px
+import streamlit as st
+
+from workbook import DEFAULT_SHEET, file_sha256, read_sheet
+
+CLEAN_CACHE_VERSION = 2  # bump when clean_columns() output changes
+# per-filter-state caches are shared by every session for the life of the
+# process; bound them so distinct slider positions can't grow memory forever
+FILTER_CACHE_ENTRIES = 64
+
+# -------------------------
+# File resolver
+# -------------------------
+def resolve_excel_path() -> Path:
+    candidates = [
+        Path("data") / "ETS.xlsx",
+        Path("ETS.xlsx"),
+        Path("/mnt/data/ETS.xlsx"),
+    ]
+    for p in candidates:
+        if p.exists():
+            return p
+    raise FileNotFoundError("ETS.xlsx not found. Put it in ./data/ETS.xlsx or beside streamlit_app.py.")
+
+# -------------------------
+# Parsing helpers
+# -------------------------
+USD_RE = re.compile(r"USD\s*([0-9]+(?:\.[0-9]+)?)", re.IGNORECASE)
+
+def parse_usd_price(s: pd.Series) -> pd.Series:
+    """
+    Extract first 'USD <number>' from 'Price rate' text (vectorized).
+    Examples:
+      'USD 59.47 / 55 EURO' -> 59.47
+      'USD 12.34 / 86.13 CNY' -> 12.34
+    """
+    usd = s.astype("string").str.extract(USD_RE, expand=False)
+    return pd.to_numeric(usd, errors="coerce").astype(float)
+
+def to_coverage_pct(s: pd.Series) -> pd.Series:
+    """
+    Converts coverage share to percentage (vectorized).
+    Accepts:
+      - 0.59 -> 59
+      - 59 -> 59
+      - '59%' -> 59
+    """
+    if not pd.api.types.is_numeric_dtype(s):
+        s = s.astype("string").str.strip().str.removesuffix("%").str.strip()
+    v = pd.to_numeric(s, errors="coerce").astype(float)
+
+    # heuristic: share vs percent
+    return v.where(v > 1.5, v * 100.0)
+
+def clean_columns(df: pd.DataFrame) -> pd.DataFrame:
+    df = df.copy()
+    df.columns = [c.strip() for c in df.columns]
+
+    # price
+    if "Price rate" in df.columns:
+        df["price_usd"] = parse_usd_price(df["Price rate"])
+    else:
+        df["price_usd"] = np.nan
+
+    # start year
+    if "Start date" in df.columns:
+        df["start_year"] = pd.to_numeric(df["Start date"], errors="coerce").astype("Int64")
+    else:
+        df["start_year"] = pd.Series(pd.NA, index=df.index, dtype="Int64")
+
+    # coverage
+    share_col = "Share of jurisdiction's"
+    if share_col in df.columns:
+        df["coverage_pct"] = to_coverage_pct(df[share_col])
+    else:
+        df["coverage_pct"] = np.nan
+
+    # clean text columns for filtering (one strip pass; blanks/'None'/'nan' -> NA)
+    for c in ["Instrument name", "Type", "Jurisdiction", "Region", "GHG", "Sector coverage"]:
+        if c in df.columns:
+            text = df[c].astype("string").str.strip()
+            df[c] = text.mask(text.isin(["", "None", "nan"]))
+
+    # lowercased search text, built once so the query is a plain substring scan
+    search = pd.Series("", index=df.index, dtype="string")
+    for c in ["Instrument name", "Jurisdiction"]:
+        if c in df.columns:
+            search = search + "\n" + df[c].fillna("").str.lower()
+    # Arrow-backed, so str.contains runs as an Arrow compute kernel
+    df["_search"] = search.astype("string[pyarrow]")
+
+    # low-cardinality filter columns: categorical codes make isin/groupby cheap
+    for c in ["Type", "Region", "Jurisdiction"]:
+        if c in df.columns:
+            df[c] = df[c].astype("category")
+
+    return df
+
+# -------------------------
+# Loading + cached pipeline
+# -------------------------
+def clean_cache_path(path: Path, sheet: str, digest: str) -> Path:
+    """Feather file holding clean_columns() output for this workbook content + sheet."""
+    slug = re.sub(r"[^0-9A-Za-z]+", "_", sheet).strip("_")
+    return path.parent / ".cache" / f"{path.stem}.{slug}.{digest[:16]}.v{CLEAN_CACHE_VERSION}.feather"
+
+@st.cache_data(show_spinner=False)
+def load_data(path: Path, sheet: str) -> pd.DataFrame:
+    digest = file_sha256(path)
+
+    # cleaned frame spilled by an earlier run for this exact workbook:
+    # survives server restarts, skips both the parse and clean_columns()
+    cache_path = clean_cache_path(path, sheet, digest)
+    if cache_path.exists():
+        try:
+            return pd.read_feather(cache_path)
+        except Exception:
+            # truncated/corrupt spill: treat as a miss and rebuild it below
+            cache_path.unlink(missing_ok=True)
+
+    # prefer the Parquet export of the default sheet (scripts/build_parquet.py),
+    # unless the workbook was edited after it was built
+    df = None
+    parquet_path = path.with_suffix(".parquet")
+    if sheet == DEFAULT_SHEET and parquet_path.exists():
+        df = pd.read_parquet(parquet_path)
+        if df.attrs.get("source_sha256") != digest:
+            df = None
+    if df is None:
+        df = read_sheet(path, sheet)
+
+    df = clean_columns(df)
+    spill_clean_cache(df, cache_path)
+    return df
+
+def spill_clean_cache(df: pd.DataFrame, cache_path: Path) -> None:
+    """
+    Best-effort write of the cleaned frame. Goes through a temp file in the
+    same directory + os.replace(), so a killed process or two servers racing
+    never leave a partial file at cache_path. Any failure (read-only checkout,
+    a column Arrow can't convert, ...) just means no spill. Once the new spill
+    is in place, older ones for the same workbook + sheet are removed.
+    """
+    tmp = None
+    try:
+        cache_path.parent.mkdir(exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=cache_path.parent, prefix=f"{cache_path.name}.", suffix=".tmp")
+        os.close(fd)
+        df.to_feather(tmp)
+        os.replace(tmp, cache_path)
+    except Exception:
+        if tmp is not None:
+            Path(tmp).unlink(missing_ok=True)
+        return
+
+    # "<stem>.<slug>.<digest>.v<N>.feather": earlier digests / cache versions
+    prefix = cache_path.name.rsplit(".", 3)[0]
+    for stale in cache_path.parent.glob(f"{prefix}.*.feather"):
+        if stale != cache_path:
+            stale.unlink(missing_ok=True)
+
+def filter_mask(df: pd.DataFrame, filters: tuple) -> np.ndarray:
+    """
+    Boolean row mask for the sidebar selections.
+    `filters` is (types, regions, year_range, price_range, coverage_range, query).
+    """
+    sel_types, sel_regions, year_range, price_range, coverage_range, q = filters
+
+    # AND every condition into one mask; callers slice once (no intermediate frames)
+    mask = np.ones(len(df), dtype=bool)
+
+    if "Type" in df.columns and sel_types:
+        mask &= df["Type"].isin(sel_types).to_numpy(dtype=bool)
+
+    if "Region" in df.columns and sel_regions:
+        mask &= df["Region"].isin(sel_regions).to_numpy(dtype=bool)
+
+    if "start_year" in df.columns:
+        in_years = df["start_year"].between(year_range[0], year_range[1]) | df["start_year"].isna()
+        mask &= in_years.to_numpy(dtype=bool)
+
+    # price filter (only apply to rows with parsed USD)
+    if "price_usd" in df.columns:
+        in_price = df["price_usd"].isna() | df["price_usd"].between(price_range[0], price_range[1])
+        mask &= in_price.to_numpy(dtype=bool)
+
+    # coverage filter (only apply to rows with coverage)
+    if "coverage_pct" in df.columns:
+        in_cov = df["coverage_pct"].isna() | df["coverage_pct"].between(coverage_range[0], coverage_range[1])
+        mask &= in_cov.to_numpy(dtype=bool)
+
+    # literal (non-regex) match against the precomputed lowercase column
+    if q:
+        mask &= df["_search"].str.contains(q.lower(), regex=False).to_numpy(dtype=bool)
+
+    return mask
+
+@st.cache_data(show_spinner=False, max_entries=FILTER_CACHE_ENTRIES)
+def filter_data(path: Path, sheet: str, filters: tuple) -> pd.DataFrame:
+    """
+    Apply the sidebar selections to the loaded sheet.
+    `filters` holds only hashable values, so reruns that don't change a
+    filter are served from cache.
+    """
+    df = load_data(path, sheet)
+    mask = filter_mask(df, filters)
+    # default selections keep every row: skip the boolean-index copy
+    return df if mask.all() else df[mask]
+
+@st.cache_data(show_spinner=False)
+def price_ranking(path: Path, sheet: str) -> pd.DataFrame:
+    """All rows with a parsed USD price, most expensive first (filter-independent)."""
+    df = load_data(path, sheet)
+    if "price_usd" not in df.columns:
+        return df.iloc[0:0]
+    return df.dropna(subset=["price_usd"]).sort_values("price_usd", ascending=False, kind="stable")
+
+@st.cache_data(show_spinner=False, max_entries=FILTER_CACHE_ENTRIES)
+def rank_by_price(path: Path, sheet: str, filters: tuple) -> pd.DataFrame:
+    """
+    Filtered rows with a parsed USD price, most expensive first. The ranking is
+    sorted once per dataset and only masked here; the Top N slider takes .head().
+    """
+    ranked = price_ranking(path, sheet)
+    mask = filter_mask(ranked, filters)
+    return ranked if mask.all() else ranked[mask]
+
+@st.cache_data(show_spinner=False, max_entries=FILTER_CACHE_ENTRIES)
+def metric_stats(path: Path, sheet: str, filters: tuple) -> pd.DataFrame:
+    """
+    count/mean/median/max of price_usd and coverage_pct for the filtered rows,
+    in one aggregation (missing columns come back as all-NaN, count 0).
+    """
+    f = filter_data(path, sheet, filters)
+    return f.reindex(columns=["price_usd", "coverage_pct"]).agg(["count", "mean", "median", "max"])
+
+@st.cache_data(show_spinner=False)
+def sidebar_options(path: Path, sheet: str) -> dict:
+    """
+    Filter choices and ready-to-use slider bounds. They depend only on the
+    dataset, not on the current selections, so they're computed once per file.
+    """
+    df = load_data(path, sheet)
+
+    def choices(c: str) -> list:
+        if c not in df.columns:
+            return []
+        if isinstance(df[c].dtype, pd.CategoricalDtype):
+            return sorted(df[c].cat.categories)
+        return sorted(df[c].dropna().unique())
+
+    def bounds(c: str):
+        ser = df[c].dropna() if c in df.columns else pd.Series([], dtype=float)
+        return (float(np.floor(ser.min())), float(np.ceil(ser.max()))) if len(ser) > 0 else None
+
+    years = bounds("start_year")
+    coverage = bounds("coverage_pct")
+    if coverage is not None:
+        cmin, cmax = coverage
+        # keep slider sane; if data somehow >100, still allow (up to 150 cap for UI)
+        slider_min = max(0.0, cmin)
+        slider_max = min(150.0, cmax) if cmax <= 150 else cmax
+        default_max = min(100.0, cmax) if cmax <= 150 else cmax
+        coverage = (slider_min, slider_max, default_max)
+
+    return {
+        "types": choices("Type"),
+        "regions": choices("Region"),
+        "years": None if years is None else (int(years[0]), int(years[1])),
+        "prices": bounds("price_usd"),
+        # (slider min, slider max, default upper bound)
+        "coverage": coverage,
+    }
+
+TABLE_COLS = [
+    "Instrument name",
+    "Type",
+    "Start date",
+    "start_year",
+    "Jurisdiction",
+    "Region",
+    "Price rate",
+    "price_usd",
+    "Share of jurisdiction's",
+    "coverage_pct",
+    "GHG",
+    "Sector coverage",
+    "Threshold",
+    "Description",
+    "Source",
+]
+
+@st.cache_data(show_spinner=False)
+def table_order(path: Path, sheet: str) -> pd.DataFrame:
+    """
+    All rows in data-table order: highest price, then coverage, then start
+    year first (filter-independent, so the sort runs once per dataset).
+    """
+    df = load_data(path, sheet)
+    sort_cols = [c for c in ["price_usd", "coverage_pct", "start_year"] if c in df.columns]
+    if not sort_cols:
+        return df
+    return df.sort_values(sort_cols, ascending=[False] * len(sort_cols), na_position="last", kind="stable")
+
+@st.cache_data(show_spinner=False, max_entries=FILTER_CACHE_ENTRIES)
+def table_view(path: Path, sheet: str, filters: tuple) -> pd.DataFrame:
+    """
+    Filtered rows as shown in the data table / CSV export: TABLE_COLS only,
+    in table_order() (masked, not re-sorted).
+    """
+    ordered = table_order(path, sheet)
+    mask = filter_mask(ordered, filters)
+    show_cols = [c for c in TABLE_COLS if c in ordered.columns]
+    return ordered.loc[mask, show_cols]
+
+# -------------------------
+# Chart builders
+# (cached per filter state: reruns that don't change a filter
+#  reuse the figure instead of rebuilding it with plotly express.
+#  st.cache_resource hands back the same object rather than an
+#  unpickled copy; st.plotly_chart only reads it (fig.to_dict()).
+#  max_entries caps the live figures held across all sessions.
+#  Histograms read off the axes, so they skip hover picking entirely)
+# -------------------------
+@st.cache_resource(show_spinner=False, max_entries=FILTER_CACHE_ENTRIES)
+def top_price_figure(path: Path, sheet: str, filters: tuple, top_n: int):
+    top = rank_by_price(path, sheet, filters).head(top_n)
+    y_col = "Instrument name" if "Instrument name" in top.columns else top.index
+    fig = px.bar(
+        top,
+        x="price_usd",
+        y=y_col,
+        orientation="h",
+        hover_data=[c for c in ["Jurisdiction", "Region", "Type", "start_year", "coverage_pct"] if c in top.columns],
+    )
+    fig.update_layout(height=520, yaxis_title="", xaxis_title="Price (USD)")
+    return fig
+
+@st.cache_resource(show_spinner=False, max_entries=FILTER_CACHE_ENTRIES)
+def price_histogram_figure(path: Path, sheet: str, filters: tuple):
+    fig = px.histogram(rank_by_price(path, sheet, filters), x="price_usd", nbins=15)
+    fig.update_layout(height=230, xaxis_title="Price (USD)", yaxis_title="Count", hovermode=False)
+    return fig
+
+@st.cache_resource(show_spinner=False, max_entries=FILTER_CACHE_ENTRIES)
+def year_price_figure(path: Path, sheet: str, filters: tuple):
+    scat = filter_data(path, sheet, filters).dropna(subset=["price_usd", "start_year"])
+    color_col = "Type" if "Type" in scat.columns else None
+    fig = px.scatter(
+        scat,
+        x="start_year",
+        y="price_usd",
+        color=color_col,
+        hover_data=[c for c in ["Instrument name", "Jurisdiction", "Region", "coverage_pct"] if c in scat.columns],
+    )
+    fig.update_layout(height=240, xaxis_title="Start year", yaxis_title="Price (USD)", hovermode="closest")
+    return fig
+
+@st.cache_resource(show_spinner=False, max_entries=FILTER_CACHE_ENTRIES)
+def coverage_histogram_figure(path: Path, sheet: str, filters: tuple):
+    f = filter_data(path, sheet, filters)
+    fig = px.histogram(f.dropna(subset=["coverage_pct"]), x="coverage_pct", nbins=12)
+    fig.update_layout(height=230, xaxis_title="Coverage (%)", yaxis_title="Count", hovermode=False)
+    return fig
+
+@st.cache_resource(show_spinner=False, max_entries=FILTER_CACHE_ENTRIES)
+def coverage_by_group_figure(path: Path, sheet: str, filters: tuple):
+    """Avg coverage by Region / Type, or None if neither column exists."""
+    f = filter_data(path, sheet, filters)
+    group_cols = [c for c in ["Region", "Type"] if c in f.columns]
+    if not group_cols:
+        return None
+
+    agg = (
+        f.dropna(subset=["coverage_pct"])
+        .groupby(group_cols, dropna=False, observed=True)["coverage_pct"]
+        .mean()
+        .reset_index()
+        .sort_values("coverage_pct", ascending=False)
+        .head(20)
+    )
+    y = "Region" if "Region" in agg.columns else group_cols[0]
+    color = "Type" if ("Type" in agg.columns and y != "Type") else None
+    fig = px.bar(agg, x="coverage_pct", y=y, color=color, orientation="h")
+    fig.update_layout(height=320, xaxis_title="Avg coverage (%)", yaxis_title="")
+    return fig
@@ -0,0 +1,40 @@
+# scripts/build_parquet.py
+# ------------------------------------------------------------
+# One-shot conversion of data/ETS.xlsx (sheet "Copy of 1. ETS")
+# to data/ETS.parquet, which streamlit_app.py reads in preference
+# to the workbook (columnar + typed, no XML parse at start-up).
+#
+# Re-run after editing ETS.xlsx:
+#   python scripts/build_parquet.py
+# ------------------------------------------------------------
+
+from __future__ import annotations
+
+import sys
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+from workbook import DEFAULT_SHEET, file_sha256, read_sheet  # noqa: E402
+
+EXCEL_PATH = ROOT / "data" / "ETS.xlsx"
+PARQUET_PATH = EXCEL_PATH.with_suffix(".parquet")
+
+def main() -> int:
+    if not EXCEL_PATH.exists():
+        print(f"{EXCEL_PATH} not found.", file=sys.stderr)
+        return 1
+
+    df = read_sheet(EXCEL_PATH, DEFAULT_SHEET)
+    # strip header whitespace once here instead of on every load
+    df.columns = [str(c).strip() for c in df.columns]
+    # lets the app detect an export that predates the current workbook
+    df.attrs["source_sha256"] = file_sha256(EXCEL_PATH)
+    df.to_parquet(PARQUET_PATH, index=False, compression="zstd")
+
+    print(f"Wrote {PARQUET_PATH} ({len(df)} rows, {len(df.columns)} columns).")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,26 @@
+# workbook.py
+# ------------------------------------------------------------
+# Raw workbook access shared by core.py and scripts/build_parquet.py.
+# No streamlit import here: the build script runs outside
+# `streamlit run`, where core's cache decorators would warn.
+# ------------------------------------------------------------
+
+from __future__ import annotations
+
+import hashlib
+from pathlib import Path
+
+import pandas as pd
+
+DEFAULT_SHEET = "Copy of 1. ETS"
+
+def read_sheet(path: Path, sheet: str) -> pd.DataFrame:
+    """
+    Read one worksheet as a raw DataFrame (first row = header).
+    Uses the calamine engine (Rust xlsx reader), several times faster than
+    openpyxl and producing the same frame.
+    """
+    return pd.read_excel(path, sheet_name=sheet, engine="calamine")
+
+def file_sha256(path: Path) -> str:
+    return hashlib.sha256(path.read_bytes()).hexdigest()